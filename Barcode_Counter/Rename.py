@@ -7,12 +7,151 @@ Original: 000000000-GRN6V_l01_n02_CoexP1_1__A1.fastq.gz -> New: CoexP1_A1_R2.fas
 
 import os
 import re
+import sys
 import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 
 
-def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=False):
+# Pattern to match the original file format including n01/n02 for R1/R2.
+# Well samples (e.g. A1) also capture letter/number so they can be zero-padded
+# without a second match; any other sample name falls through unchanged.
+# Names are ASCII-only, so \d does not need Unicode digit lookups.
+_FILE_RE = re.compile(
+    r'000000000-GRN6V_l01_n0(?P<read>[12])_(?P<proj>[^_]+)_\d+__'
+    r'(?P<sample>(?P<letter>[A-Z]+)(?P<num>\d+)[^.]*|[^.]+)\.fastq\.gz',
+    re.ASCII
+)
+
+# Literal part of every matching filename, used as a cheap prefilter
+_FILE_MARKER = "-GRN6V_l01_n0"
+
+
+# Number of per-file status lines buffered before writing to stdout
+_PRINT_BLOCK = 256
+
+# Bytes requested per in-kernel copy call
+_COPY_CHUNK = 1 << 30
+
+
+def _copy_contents(fsrc, fdst):
+    """
+    Copy file contents in-kernel (copy_file_range, then sendfile) where available,
+    falling back to a regular buffered copy
+    """
+    src_fd = fsrc.fileno()
+    dst_fd = fdst.fileno()
+    src_size = os.fstat(src_fd).st_size
+    
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(lambda: os.copy_file_range(src_fd, dst_fd, _COPY_CHUNK))
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(lambda: os.sendfile(dst_fd, src_fd, None, _COPY_CHUNK))
+    
+    for copy_chunk in kernel_copies:
+        copied = 0
+        try:
+            while True:
+                n = copy_chunk()
+                if n <= 0:
+                    break
+                copied += n
+        except OSError:
+            copied = -1
+        
+        # Some filesystems report 0 bytes without raising instead of copying
+        if copied >= src_size:
+            return
+        
+        # Not supported for this file/filesystem; start over with the next method
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+        os.ftruncate(dst_fd, 0)
+    
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def _fast_copy(old_path, new_path):
+    """
+    Copy a file with _copy_contents, then copy metadata like shutil.copy2
+    
+    The source is opened first and the target is created exclusively, so
+    FileExistsError is raised if it already exists; a target left incomplete
+    by a failed copy is removed so a rerun does not mistake it for finished output
+    """
+    with open(old_path, 'rb') as fsrc:
+        fdst = open(new_path, 'xb')
+        try:
+            with fdst:
+                _copy_contents(fsrc, fdst)
+            shutil.copystat(old_path, new_path)
+        except BaseException:
+            os.unlink(new_path)
+            raise
+
+
+def _flush_lines(lines):
+    """Write buffered status lines to stdout in one call and clear the buffer"""
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        lines.clear()
+
+
+def _exists_message(old_path, new_path):
+    """Status line for a file skipped because its target name is already taken"""
+    return (f"Warning: {os.path.basename(new_path)} already exists, "
+            f"skipping {os.path.basename(old_path)}")
+
+
+def _process_file(old_path, new_path, output_dir, use_symlinks, fast_copy=False, abs_src_dir=None):
+    """
+    Rename, symlink or copy a single file
+    
+    Symlinks point into abs_src_dir (the absolute source directory) when given,
+    so callers can resolve it once instead of per file. Symlinks and fast copies
+    create their target exclusively, so an existing target is never overwritten;
+    callers running this concurrently must not pass the same new_path twice
+    
+    Returns: (success, message) tuple
+    """
+    old_name = os.path.basename(old_path)
+    new_name = os.path.basename(new_path)
+    try:
+        # Check if new filename already exists (a single lstat, also catches dangling symlinks)
+        if os.path.lexists(new_path):
+            return False, _exists_message(old_path, new_path)
+        
+        # Perform the operation based on mode
+        if output_dir:
+            if use_symlinks:
+                # Create symlink
+                if abs_src_dir is None:
+                    target = os.path.abspath(old_path)
+                else:
+                    target = os.path.join(abs_src_dir, old_name)
+                os.symlink(target, new_path)
+                return True, f"Symlinked: {old_name} -> {new_name}"
+            # Copy file
+            if fast_copy:
+                _fast_copy(old_path, new_path)
+            else:
+                shutil.copy2(old_path, new_path)
+            return True, f"Copied: {old_name} -> {new_name}"
+        # Rename in place
+        os.replace(old_path, new_path)
+        return True, f"Renamed: {old_name} -> {new_name}"
+    
+    except FileExistsError:
+        return False, _exists_message(old_path, new_path)
+    except Exception as e:
+        return False, f"Error processing {old_name}: {e}"
+
+
+def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=False, jobs=1,
+                       fast_copy=False, quiet=False):
     """
     Rename fastq files from GRN6V format to simplified CoexP format with R1/R2
     
@@ -21,6 +160,9 @@ def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=F
     output_dir (str): Output directory for renamed files (optional, defaults to same as input)
     dry_run (bool): If True, only show what would be renamed without actually renaming
     use_symlinks (bool): If True, create symlinks instead of copying files
+    jobs (int): Number of parallel copy workers (copy mode only, 0 = auto)
+    fast_copy (bool): If True, copy file contents in-kernel where supported
+    quiet (bool): If True, only report files that could not be processed
     """
     
     fastq_path = Path(fastq_dir)
@@ -28,6 +170,9 @@ def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=F
     if not fastq_path.exists():
         print(f"Error: Directory {fastq_dir} does not exist")
         return
+    if not fastq_path.is_dir():
+        print(f"Error: {fastq_dir} is not a directory")
+        return
     
     # Set output directory
     if output_dir:
@@ -35,34 +180,39 @@ def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=F
         output_path.mkdir(parents=True, exist_ok=True)
     else:
         output_path = fastq_path
-    
-    # Pattern to match the original file format including n01/n02 for R1/R2
-    pattern = re.compile(r'000000000-GRN6V_l01_n0([12])_([^_]+)_\d+__([^.]+)\.fastq\.gz')
+    output_dir_str = str(output_path)
     
     files_to_rename = []
     
-    # Find all matching files
-    for file_path in fastq_path.glob("*.fastq.gz"):
-        match = pattern.match(file_path.name)
+    # Find all matching files (scandir avoids building a Path per directory entry);
+    # the literal substring check rejects unrelated files before the regex runs
+    with os.scandir(fastq_dir) as it:
+        entries = [
+            entry for entry in it
+            if entry.name.endswith(".fastq.gz") and _FILE_MARKER in entry.name
+            and entry.is_file()
+        ]
+
+    for entry in entries:
+        match = _FILE_RE.fullmatch(entry.name)
         if match:
-            read_num = match.group(1)      # 1 or 2
-            project_name = match.group(2)  # e.g., "CoexP1"
-            sample_name = match.group(3)   # e.g., "A1"
+            read_num = match['read']        # 1 or 2
+            project_name = match['proj']    # e.g., "CoexP1"
             
             # ZERO-PAD THE WELL NUMBERS
-            well_match = re.match(r'([A-Z]+)(\d+)', sample_name)
-            if well_match:
-                letter = well_match.group(1)
-                number = well_match.group(2).zfill(2)  # Zero-pad to 2 digits
-                sample_name_padded = f"{letter}{number}"
+            if match['letter']:
+                number = match['num'].zfill(2)  # Zero-pad to 2 digits
+                sample_name_padded = f"{match['letter']}{number}"
             else:
-                sample_name_padded = sample_name
+                sample_name_padded = match['sample']
             
             # Create new filename with R1/R2 and zero-padded well numbers
             new_name = f"{project_name}_{sample_name_padded}_R{read_num}.fastq.gz"
-            new_path = output_path / new_name
+            new_path = os.path.join(output_dir_str, new_name)
             
-            files_to_rename.append((file_path, new_path))
+            # Sort key: sample name, then full new name (R1 before R2)
+            sort_key = (sample_name_padded, new_name)
+            files_to_rename.append((sort_key, entry.path, new_path))
         
     if not files_to_rename:
         print("No files matching the expected pattern found.")
@@ -70,7 +220,8 @@ def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=F
         return
     
     # Sort by sample name and read number for cleaner output
-    files_to_rename.sort(key=lambda x: (x[1].name.split('_')[1], x[1].name))
+    files_to_rename.sort(key=itemgetter(0))
+    files_to_rename = [(old_path, new_path) for _, old_path, new_path in files_to_rename]
     
     print(f"Found {len(files_to_rename)} files to rename:")
     if output_dir:
@@ -85,40 +236,51 @@ def rename_fastq_files(fastq_dir, output_dir=None, dry_run=False, use_symlinks=F
     
     success_count = 0
     error_count = 0
+    lines = []
     
-    for old_path, new_path in files_to_rename:
-        if dry_run:
-            action = "symlink" if use_symlinks and output_dir else "rename/copy"
-            print(f"Would {action}: {old_path.name} -> {new_path.name}")
+    if dry_run:
+        action = "symlink" if use_symlinks and output_dir else "rename/copy"
+        if not quiet:
+            for old_path, new_path in files_to_rename:
+                lines.append(f"Would {action}: {os.path.basename(old_path)} -> {os.path.basename(new_path)}")
+                if len(lines) >= _PRINT_BLOCK:
+                    _flush_lines(lines)
+    else:
+        abs_src_dir = os.path.abspath(fastq_dir)
+        
+        # Several source files can map to the same new name; the first in sort order
+        # wins and the rest are skipped up front, so workers never race for a target
+        seen = set()
+        tasks = []
+        for old_path, new_path in files_to_rename:
+            tasks.append((old_path, new_path, new_path in seen))
+            seen.add(new_path)
+        
+        def process(task):
+            old_path, new_path, duplicate = task
+            if duplicate:
+                return False, _exists_message(old_path, new_path)
+            return _process_file(old_path, new_path, output_dir, use_symlinks, fast_copy, abs_src_dir)
+        
+        # Copies are I/O bound, so they can run on a thread pool
+        if output_dir and not use_symlinks and jobs != 1:
+            max_workers = jobs if jobs > 0 else min(32, (os.cpu_count() or 1) * 4)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(process, tasks))
         else:
-            try:
-                # Check if new filename already exists
-                if new_path.exists() or new_path.is_symlink():
-                    print(f"Warning: {new_path.name} already exists, skipping {old_path.name}")
-                    error_count += 1
-                    continue
-                
-                # Perform the operation based on mode
-                if output_dir:
-                    if use_symlinks:
-                        # Create symlink
-                        new_path.symlink_to(old_path.absolute())
-                        print(f"Symlinked: {old_path.name} -> {new_path.name}")
-                    else:
-                        # Copy file
-                        shutil.copy2(old_path, new_path)
-                        print(f"Copied: {old_path.name} -> {new_path.name}")
-                else:
-                    # Rename in place
-                    old_path.rename(new_path)
-                    print(f"Renamed: {old_path.name} -> {new_path.name}")
-                
+            results = map(process, tasks)
+        
+        for ok, message in results:
+            if ok:
                 success_count += 1
-                
-            except Exception as e:
-                print(f"Error processing {old_path.name}: {e}")
+            else:
                 error_count += 1
+            if not (ok and quiet):
+                lines.append(message)
+                if len(lines) >= _PRINT_BLOCK:
+                    _flush_lines(lines)
     
+    _flush_lines(lines)
     print("-" * 80)
     if dry_run:
         print(f"Dry run complete. {len(files_to_rename)} files would be processed.")
@@ -143,6 +305,9 @@ Examples:
   # Copy files with new names to output directory
   python rename.py /path/to/fastq/files --output-dir /path/to/output
   
+  # Copy files using 8 parallel workers
+  python rename.py /path/to/fastq/files --output-dir /path/to/output --jobs 8
+  
   # Create symlinks with new names to output directory
   python rename.py /path/to/fastq/files --output-dir /path/to/output --symlinks
   
@@ -174,13 +339,33 @@ File format expected:
         help="Show what would be renamed without actually renaming files"
     )
     
+    parser.add_argument(
+        "--quiet", "-q",
+        action="store_true",
+        help="Only report files that could not be processed, plus the summary"
+    )
+    
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of parallel copy workers when copying to --output-dir (0 = auto)"
+    )
+    
+    parser.add_argument(
+        "--fast-copy",
+        action="store_true",
+        help="Copy file contents in-kernel (copy_file_range/sendfile) where supported"
+    )
+    
     args = parser.parse_args()
     
     if args.symlinks and not args.output_dir:
         print("Warning: --symlinks requires --output-dir. Ignoring --symlinks flag.")
         args.symlinks = False
     
-    rename_fastq_files(args.fastq_dir, args.output_dir, args.dry_run, args.symlinks)
+    rename_fastq_files(args.fastq_dir, args.output_dir, args.dry_run, args.symlinks,
+                       args.jobs, args.fast_copy, args.quiet)
 
 
 if __name__ == "__main__":
@@ -7,11 +7,21 @@ Analyzes pairs 1, 2, and 8 from 12-well plate data (C_ format)
 
 import pandas as pd
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
-import re
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+from matplotlib.lines import Line2D
 import warnings
 warnings.filterwarnings('ignore')
 
+# Use the multithreaded pyarrow CSV reader when it is installed
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = pacsv = None
+
 # Clean matplotlib styling
 plt.style.use('default')
 plt.rcParams.update({
@@ -33,9 +43,12 @@ class TwelveWellAnalyzer:
         self.barcode_file = barcode_file
         self.platemap_file = platemap_file
         
-        # Load data
-        self.barcode_data = pd.read_csv(barcode_file)
+        # Load data (plate map first, so only its sample columns are parsed)
         self.plate_map = self._load_plate_map()
+        self._barcode_table = None
+        self._barcode_data = None
+        self._load_barcode_data()
+        self._all_data = None
         
         # Define strain pairs (just the 12-well ones)
         self.strain_pairs = {
@@ -54,82 +67,146 @@ class TwelveWellAnalyzer:
     def _load_plate_map(self):
         """Load plate map - focuses on C_ (control/12-well) entries"""
         df = pd.read_csv(self.platemap_file)
-        plate_map = {}
+        condition_str = df[df.columns[2]].astype(str).str.strip()
         
-        for _, row in df.iterrows():
-            plate = row['PLATE']
-            well = row['WELL']
-            condition_str = str(row[df.columns[2]]).strip()
-            
-            parts = condition_str.split('_')
-            key = f"P{plate}_{well}"
-            
-            # Only load C_ entries (12-well plate data)
-            if len(parts) >= 5 and parts[0] == 'C':
-                plate_map[key] = {
-                    'pair': parts[1],
-                    'condition': parts[2],
-                    'replicate': parts[3],
-                    'timepoint': parts[4]
-                }
+        # Only load C_ entries (12-well plate data)
+        is_control = condition_str.str.startswith('C_')
+        df = df[is_control]
+        parts = condition_str[is_control].str.split('_', expand=True).reindex(columns=range(5))
+        
+        has_timepoint = parts[4].notna()
+        df = df[has_timepoint]
+        parts = parts.loc[has_timepoint, [1, 2, 3, 4]]
+        parts.columns = ['pair', 'condition', 'replicate', 'timepoint']
+        
+        keys = zip(df['PLATE'].astype(int), df['WELL'])
+        plate_map = dict(zip(keys, parts.to_dict('records')))
         
         print(f"Loaded {len(plate_map)} wells from 12-well plates")
         return plate_map
     
+    def _load_barcode_data(self):
+        """
+        Load barcode counts, keeping only the sample columns referenced by the plate map
+        
+        With pyarrow installed the file is kept as an Arrow table and converted to
+        pandas on first use of barcode_data; otherwise it is read with pandas directly
+        """
+        header = pd.read_csv(self.barcode_file, nrows=0).columns
+        barcode_col = header[0]
+        sample_cols, wells = self._parse_sample_columns(header[1:])
+        sample_cols = list(sample_cols[wells.isin(list(self.plate_map))])
+        
+        if pacsv is None:
+            dtype = {barcode_col: 'category', **{col: 'Int32' for col in sample_cols}}
+            df = pd.read_csv(self.barcode_file, usecols=[barcode_col] + sample_cols, dtype=dtype)
+            
+            # Match pyarrow's conversion: int32, or float64 (NaN) for columns with empty cells
+            has_na = df[sample_cols].isna().any()
+            self._barcode_data = df.astype({col: 'float64' if has_na[col] else 'int32'
+                                            for col in sample_cols})
+            return
+        
+        column_types = {barcode_col: pa.dictionary(pa.int32(), pa.string()),
+                        **{col: pa.int32() for col in sample_cols}}
+        self._barcode_table = pacsv.read_csv(
+            self.barcode_file,
+            read_options=pacsv.ReadOptions(block_size=1 << 22),
+            convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                                 include_columns=[barcode_col] + sample_cols))
+    
+    @property
+    def barcode_data(self):
+        """Barcode counts as a DataFrame (BCID column first, then sample columns)"""
+        if self._barcode_data is None:
+            self._barcode_data = self._barcode_table.to_pandas()
+        return self._barcode_data
+    
+    @staticmethod
+    def _parse_sample_columns(columns):
+        """
+        Parse column names like 'CoexP2_C1' to (plate, well) keys like (2, 'C1')
+        
+        Returns: (matching column names, MultiIndex of (plate, well))
+        """
+        parsed = columns.to_series().str.extract(r'^CoexP(\d+)_([A-H]\d+)').dropna()
+        wells = pd.MultiIndex.from_arrays([parsed[0].astype(int), parsed[1]])
+        return parsed.index, wells
+    
+    @staticmethod
+    def _group_sum(df, keys, value_col):
+        """
+        Sum value_col for each unique combination of keys (like groupby().sum().reset_index())
+        
+        Sorts once with np.lexsort and sums contiguous runs with np.add.reduceat
+        """
+        if df.empty:
+            return df[keys + [value_col]].reset_index(drop=True)
+        
+        key_arrays = [np.asarray(df[key]) for key in keys]
+        order = np.lexsort(key_arrays[::-1])  # lexsort treats the last key as primary
+        sorted_keys = [arr[order] for arr in key_arrays]
+        
+        boundaries = np.zeros(len(order), dtype=bool)
+        boundaries[0] = True
+        for arr in sorted_keys:
+            boundaries[1:] |= arr[1:] != arr[:-1]
+        starts = np.flatnonzero(boundaries)
+        
+        sums = np.add.reduceat(np.asarray(df[value_col])[order], starts)
+        result = {key: arr[starts] for key, arr in zip(keys, sorted_keys)}
+        result[value_col] = sums
+        return pd.DataFrame(result)
+    
     def _get_strain_color(self, barcode):
         if barcode in self.strain_colors:
             return self.strain_colors[barcode]
         return '#999999'  # Gray fallback
     
-    def _parse_column_name(self, col_name):
-        """Parse column names like 'CoexP2_C1'"""
-        if col_name == 'BCID':
-            return None
-        match = re.match(r'CoexP(\d+)_([A-H]\d+)', col_name)
-        if match:
-            return {'plate': int(match.group(1)), 'well': match.group(2)}
-        return None
+    def _sample_metadata(self):
+        """Plate map metadata for each mapped sample column, indexed by column name"""
+        sample_cols, wells = self._parse_sample_columns(self.barcode_data.columns[1:])
+        
+        metadata = pd.DataFrame(list(self.plate_map.values()),
+                                index=pd.MultiIndex.from_tuples(list(self.plate_map), names=['plate', 'well']),
+                                columns=['pair', 'condition', 'replicate', 'timepoint'])
+        
+        sample_meta = metadata.reindex(wells)
+        sample_meta.index = sample_cols
+        return sample_meta[wells.isin(metadata.index)]
+    
+    @property
+    def all_data(self):
+        """Processed long-form data, computed on first access"""
+        if self._all_data is None:
+            self._all_data = self._compute_all_data()
+        return self._all_data
     
     def process_all_data(self):
         """Process barcode data with plate map metadata"""
-        all_data = []
+        return self.all_data
+    
+    def _compute_all_data(self):
+        """Melt barcode counts to long form and attach plate map metadata"""
         barcode_col = self.barcode_data.columns[0]
         
-        for col in self.barcode_data.columns[1:]:
-            parsed = self._parse_column_name(col)
-            if not parsed:
-                continue
-            
-            key = f"P{parsed['plate']}_{parsed['well']}"
-            if key not in self.plate_map:
-                continue
-            
-            metadata = self.plate_map[key]
-            
-            # Get barcode frequencies for this sample
-            sample_data = self.barcode_data[[barcode_col, col]].copy()
-            sample_data = sample_data[sample_data[col] > 0]
-            
-            for _, row in sample_data.iterrows():
-                try:
-                    timepoint = int(metadata['timepoint'])
-                except (ValueError, KeyError):
-                    continue
-                    
-                all_data.append({
-                    'barcode': row[barcode_col],
-                    'frequency': row[col],
-                    'pair': metadata['pair'],
-                    'condition': metadata['condition'],
-                    'timepoint': timepoint,
-                    'replicate': metadata['replicate']
-                })
+        # Sample metadata, skipping wells whose timepoint int() would reject (e.g. '1.5', 'x')
+        metadata = self._sample_metadata()
+        is_int = metadata['timepoint'].astype(str).str.fullmatch(r'\s*[+-]?\d+\s*')
+        metadata = metadata[is_int].astype({'timepoint': int})
         
-        return pd.DataFrame(all_data)
+        # Long form: one row per (barcode, sample) with a non-zero count
+        long_data = self.barcode_data.melt(id_vars=[barcode_col], value_vars=list(metadata.index),
+                                           var_name='sample', value_name='frequency')
+        long_data = long_data[long_data['frequency'] > 0]
+        
+        df = long_data.merge(metadata, left_on='sample', right_index=True)
+        df = df.rename(columns={barcode_col: 'barcode'})
+        return df[['barcode', 'frequency', 'pair', 'condition', 'timepoint', 'replicate']].reset_index(drop=True)
     
-    def create_pair_plot(self, pair_number):
-        """Create competition plot for a specific pair"""
-        df = self.process_all_data()
+    def create_pair_plot(self, pair_number, show=False):
+        """Create competition plot for a specific pair (shown interactively only if show=True)"""
+        df = self.all_data
         pair_str = str(pair_number)
         pair_data = df[df['pair'] == pair_str].copy()
         
@@ -170,24 +247,17 @@ class TwelveWellAnalyzer:
             cond_data = pair_data[pair_data['condition'] == condition].copy()
             
             # Group and normalize
-            grouped = cond_data.groupby(['timepoint', 'replicate', 'barcode'])['frequency'].sum().reset_index()
+            grouped = self._group_sum(cond_data, ['timepoint', 'replicate', 'barcode'], 'frequency')
             
-            # Two-strain normalization
-            for tp in grouped['timepoint'].unique():
-                for rep in grouped['replicate'].unique():
-                    mask = (grouped['timepoint'] == tp) & (grouped['replicate'] == rep)
-                    tp_rep_data = grouped[mask]
-                    
-                    s1_freq = tp_rep_data[tp_rep_data['barcode'] == expected_strain_1]['frequency'].sum()
-                    s2_freq = tp_rep_data[tp_rep_data['barcode'] == expected_strain_2]['frequency'].sum()
-                    total = s1_freq + s2_freq
-                    
-                    if total > 0:
-                        grouped.loc[mask & (grouped['barcode'] == expected_strain_1), 'frequency'] = s1_freq / total
-                        grouped.loc[mask & (grouped['barcode'] == expected_strain_2), 'frequency'] = s2_freq / total
-                        grouped.loc[mask & (~grouped['barcode'].isin([expected_strain_1, expected_strain_2])), 'frequency'] = 0
+            # Two-strain normalization: A/(A+B) and B/(A+B) per timepoint-replicate, others set to 0
+            is_pair = grouped['barcode'].isin([expected_strain_1, expected_strain_2])
+            two_strain = grouped[is_pair]
+            totals = two_strain.groupby(['timepoint', 'replicate'])['frequency'].transform('sum')
+            two_strain = two_strain.assign(frequency=two_strain['frequency'] / totals.where(totals > 0, 1))
+            grouped = pd.concat([two_strain, grouped[~is_pair].assign(frequency=0.0)])
             
-            # Plot both strains
+            # Plot both strains: one LineCollection for all lines and one scatter for all markers
+            segments, colors, linestyles, handles = [], [], [], []
             for barcode in [expected_strain_1, expected_strain_2]:
                 strain_data = grouped[grouped['barcode'] == barcode]
                 if strain_data.empty:
@@ -203,10 +273,19 @@ class TwelveWellAnalyzer:
                         alpha = 0.9 if rep == '1' else 0.7
                         label = f'{barcode}' + (f' (R{rep})' if len(strain_data['replicate'].unique()) > 1 else '')
                         
-                        ax.plot(rep_data['timepoint'], rep_data['frequency'],
-                               marker='o', linewidth=3, markersize=8, color=color,
-                               linestyle=linestyle, alpha=alpha, label=label,
-                               markeredgecolor='white', markeredgewidth=0.5)
+                        segments.append(np.column_stack([rep_data['timepoint'], rep_data['frequency']]))
+                        colors.append(to_rgba(color, alpha))
+                        linestyles.append(linestyle)
+                        handles.append(Line2D([], [], marker='o', linewidth=3, markersize=8, color=color,
+                                              linestyle=linestyle, alpha=alpha, label=label,
+                                              markeredgecolor='white', markeredgewidth=0.5))
+            
+            if segments:
+                ax.add_collection(LineCollection(segments, colors=colors, linestyles=linestyles, linewidths=3))
+                points = np.concatenate(segments)
+                point_colors = np.repeat(colors, [len(seg) for seg in segments], axis=0)
+                ax.scatter(points[:, 0], points[:, 1], s=8 ** 2, c=point_colors,
+                           edgecolors='white', linewidths=0.5, zorder=3)
             
             # Style subplot
             ax.set_xlabel('Timepoint', fontweight='bold')
@@ -221,26 +300,29 @@ class TwelveWellAnalyzer:
             ax.set_ylim(0, 1.05)
             ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda y, _: f'{y:.2f}'))
             ax.axhline(y=0.5, color='gray', linestyle=':', alpha=0.5, linewidth=1)
-            ax.legend(loc='best', frameon=True, fancybox=True, shadow=True, framealpha=0.9)
+            ax.legend(handles=handles, loc='best', frameon=True, fancybox=True, shadow=True, framealpha=0.9)
         
         # Hide empty subplots
         for idx in range(len(conditions), len(axes_flat)):
             axes_flat[idx].set_visible(False)
         
-        plt.tight_layout()
-        plt.savefig(f'Images/Pair{pair_number}_competition.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        fig.tight_layout()
+        fig.savefig(f'Images/Pair{pair_number}_competition.png', dpi=300)
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
         print(f"Plot saved as Images/12well_Pair{pair_number}_competition.png")
     
-    def analyze_all_12well_pairs(self):
-        """Analyze all three 12-well pairs"""
+    def analyze_all_12well_pairs(self, show=False):
+        """Analyze all three 12-well pairs (shown interactively only if show=True)"""
         for pair_num in [1, 2, 8]:
             print(f"\nProcessing Pair {pair_num}...")
-            self.create_pair_plot(pair_num)
+            self.create_pair_plot(pair_num, show=show)
     
     def export_processed_data(self, output_file='12well_competition_data.csv'):
         """Export processed data"""
-        df = self.process_all_data()
+        df = self.all_data
         df.to_csv(output_file, index=False)
         print(f"Data exported to {output_file}")
         return df
@@ -248,6 +330,9 @@ class TwelveWellAnalyzer:
 
 def main():
     """Run analysis"""
+    # Batch mode: render straight to PNG without a GUI backend
+    matplotlib.use('Agg')
+    
     # File paths
     barcode_file = "barcodecounts_clean.csv"
     platemap_file = "Coexistance_Assay_plate_map.csv"
@@ -8,11 +8,25 @@ Uses plate map to automatically assign experimental conditions to barcode count
 
 import pandas as pd
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import contextlib
+import io
+import os
 import re
+import sys
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 warnings.filterwarnings('ignore')
 
+# Compile the normalization kernel with numba when it is installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
 # Clean matplotlib styling
 plt.style.use('default')
 plt.rcParams.update({
@@ -29,7 +43,42 @@ plt.rcParams.update({
     'axes.facecolor': 'white'
 })
 
+if njit is not None:
+    @njit(cache=True)
+    def _normalize_by_group(gid, freq, n_groups):
+        """Divide each frequency by the total of its group, in place"""
+        totals = np.zeros(n_groups)
+        for i in range(len(gid)):
+            totals[gid[i]] += freq[i]
+        for i in range(len(gid)):
+            freq[i] /= totals[gid[i]]
+        return freq
+else:
+    def _normalize_by_group(gid, freq, n_groups):
+        """Divide each frequency by the total of its group, in place"""
+        freq /= np.bincount(gid, weights=freq, minlength=n_groups)[gid]
+        return freq
+
+# Analyzer shared by every task in an analyze_all_pairs worker process
+_worker_analyzer = None
+
+def _init_worker(analyzer):
+    """Process pool initializer: use the Agg backend and keep one copy of the analyzer"""
+    global _worker_analyzer
+    matplotlib.use('Agg')
+    _worker_analyzer = analyzer
+
+def _render_pair(pair_num):
+    """Plot one pair in a worker process, returning what it printed"""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        _worker_analyzer.create_pair_plot(pair_num)
+    return out.getvalue()
+
 class PlateMapStrainAnalyzer:
+    # Sample column names: CoexP[plate]_[well]
+    _COL_RE = re.compile(r'^CoexP(\d+)_([A-H]\d+)')
+    
     def __init__(self, barcode_file, platemap_file):
         """
         Initialize analyzer with barcode counts and plate map
@@ -45,8 +94,13 @@ class PlateMapStrainAnalyzer:
         self.platemap_file = platemap_file
         
         # Load data
-        self.barcode_data = pd.read_csv(barcode_file)
+        self.barcode_data = self._load_barcode_data()
         self.plate_map = self._load_plate_map()
+        self.plate_map_df = self._plate_map_frame()
+        self._cols_by_pair = self._columns_by_pair()
+        self._processed = None
+        self._by_pair = {}
+        self._fig_cache = {}
         
         # Define strain pairs
         self.strain_pairs = {
@@ -67,75 +121,89 @@ class PlateMapStrainAnalyzer:
             'P3D9': '#85C1E9',   'P3A7': '#F8C471',   'P5F8': '#82E0AA',
             'P4C11': '#F1948A'
         }
+        self._color_cache = dict(self.strain_colors)
     
-    def _load_plate_map(self):
-    df = pd.read_csv(self.platemap_file)
-    plate_map = {}
+    def _load_barcode_data(self):
+        """
+        Load barcode counts, keeping only the barcode and CoexP sample columns
+        
+        The header is read first so counts can be parsed straight to int32
+        instead of having pandas infer int64 for every column
+        """
+        header = pd.read_csv(self.barcode_file, nrows=0).columns
+        barcode_col = header[0]
+        sample_cols = [col for col in header[1:] if self._COL_RE.match(col)]
+        
+        dtype = {barcode_col: 'string', **{col: 'Int32' for col in sample_cols}}
+        df = pd.read_csv(self.barcode_file, usecols=[barcode_col] + sample_cols, dtype=dtype,
+                         engine='c', memory_map=True)
+        
+        # Plain int32 counts, or float64 (NaN) for columns with empty cells
+        has_na = df[sample_cols].isna().any()
+        return df.astype({col: 'float64' if has_na[col] else 'int32' for col in sample_cols})
     
-        for _, row in df.iterrows():
-            plate = row['PLATE']
-            well = row['WELL']
-            condition_str = row[df.columns[2]]  # Third column
-            
-            parts = condition_str.strip().split('_')
-            key = f"P{plate}_{well}"
-            
-            # Handle special cases (SALT, GAL)
-            if len(parts) > 1 and parts[1] in ['SALT', 'GAL']:
-                plate_map[key] = {
-                    'type': 'pair',
-                    'pair': parts[2].replace('P', '') if len(parts) > 2 else 'Unknown',
-                    'condition': parts[1],
-                    'replicate': parts[3] if len(parts) > 3 else '1',
-                    'timepoint': '1'
-                }
-            elif len(parts) >= 5:
-                # Check if it's control (C_) or pair (P_)
-                if parts[0] == 'C':
-                    # TREAT CONTROLS AS PAIRS for plotting
-                    plate_map[key] = {
-                        'type': 'pair',  # Changed from 'control' to 'pair'
-                        'pair': parts[1],  # Use control_id as pair number
-                        'condition': parts[2],
-                        'replicate': parts[3] if len(parts) > 3 else '1',
-                        'timepoint': parts[4] if len(parts) > 4 else '1'
-                    }
-                elif parts[0] == 'P':
-                    plate_map[key] = {
-                        'type': 'pair',
-                        'pair': parts[1],
-                        'condition': parts[2],
-                        'replicate': parts[3],
-                        'timepoint': parts[4] if len(parts) > 4 else '1'
-                    }
+    def _load_plate_map(self):
+        """Load plate map keyed on (plate, well), e.g. (2, 'E8')"""
+        df = pd.read_csv(self.platemap_file)
+        condition_str = df[df.columns[2]].str.strip()  # Third column
+        parts = condition_str.str.split('_', expand=True).reindex(columns=range(5))
+        n_parts = parts.notna().sum(axis=1)
+        
+        # Handle special cases (SALT, GAL); otherwise load C_ and P_ entries,
+        # treating controls as pairs for plotting
+        is_special = parts[1].isin(['SALT', 'GAL'])
+        is_pair = ~is_special & (n_parts >= 5) & parts[0].isin(['C', 'P'])
+        keep = is_special | is_pair
+        
+        records = pd.DataFrame({
+            'type': 'pair',
+            'pair': parts[1].where(is_pair, parts[2].str.replace('P', '').fillna('Unknown')),
+            'condition': parts[2].where(is_pair, parts[1]),
+            'replicate': parts[3].fillna('1'),
+            'timepoint': parts[4].where(is_pair, '1')
+        })[keep]
+        
+        keys = zip(df.loc[keep, 'PLATE'].astype(int), df.loc[keep, 'WELL'])
+        plate_map = dict(zip(keys, records.to_dict('records')))
         
         return plate_map
     
-    def _get_strain_color(self, barcode):
-        """Get color for a strain"""
-        if barcode in self.strain_colors:
-            return self.strain_colors[barcode]
-        # Fallback colors
-        fallback_colors = ['#85D4E3', '#D7BDE2', '#A3E4D7', '#FAD7A0', '#AED6F1']
-        return fallback_colors[hash(barcode) % len(fallback_colors)]
+    def _plate_map_frame(self):
+        """Plate map as a DataFrame indexed by (plate, well)"""
+        return pd.DataFrame(list(self.plate_map.values()),
+                            index=pd.MultiIndex.from_tuples(list(self.plate_map), names=['plate', 'well']),
+                            columns=['type', 'pair', 'condition', 'replicate', 'timepoint'])
     
-    def _parse_column_name(self, col_name):
-        """
-        Parse column names like 'CoexP2_E8' to extract plate and well
-        
-        Returns: {'plate': 2, 'well': 'E8'} or None
-        """
-        if col_name == 'BCID':
-            return None
+    def __getstate__(self):
+        """Pickle without cached figures (e.g. when sent to worker processes)"""
+        state = self.__dict__.copy()
+        state['_fig_cache'] = {}
+        return state
+    
+    def _get_figure(self, nrows, ncols, figsize):
+        """Return a Figure and its flattened axes for an nrows x ncols grid, reused across plots"""
+        key = (nrows, ncols)
+        if key not in self._fig_cache:
+            fig = Figure(figsize=figsize)
+            self._fig_cache[key] = (fig, fig.subplots(nrows, ncols).flatten())
+            return self._fig_cache[key]
         
-        # Match pattern: CoexP[plate]_[well]
-        match = re.match(r'CoexP(\d+)_([A-H]\d+)', col_name)
-        if match:
-            return {
-                'plate': int(match.group(1)),
-                'well': match.group(2)
-            }
-        return None
+        # Clear the previous plot but keep the figure and axes
+        fig, axes_flat = self._fig_cache[key]
+        for ax in axes_flat:
+            ax.cla()
+            ax.set_visible(True)
+        return fig, axes_flat
+    
+    def _get_strain_color(self, barcode):
+        """Get color for a strain (unlisted strains get fallback colors in order of first use)"""
+        color = self._color_cache.get(barcode)
+        if color is None:
+            # Fallback colors
+            fallback_colors = ['#85D4E3', '#D7BDE2', '#A3E4D7', '#FAD7A0', '#AED6F1']
+            color = fallback_colors[len(self._color_cache) % len(fallback_colors)]
+            self._color_cache[barcode] = color
+        return color
     
     def process_all_data(self):
         """
@@ -149,54 +217,69 @@ class PlateMapStrainAnalyzer:
         - timepoint: timepoint
         - replicate: replicate number
         """
-        all_data = []
-        
         # Get barcode column (first column)
         barcode_col = self.barcode_data.columns[0]
+        metadata = self._sample_metadata(warn=True)
         
-        # Process each sample column
-        for col in self.barcode_data.columns[1:]:
-            # Parse column name to get plate and well
-            parsed = self._parse_column_name(col)
-            if not parsed:
-                continue
-            
-            # Look up this well in the plate map
-            key = f"P{parsed['plate']}_{parsed['well']}"
-            if key not in self.plate_map:
-                print(f"Warning: {key} not found in plate map")
-                continue
-            
-            metadata = self.plate_map[key]
-            
-            # Skip controls if you only want pairs
-            if metadata['type'] != 'pair':
-                continue
-            
-            # Get barcode frequencies for this sample
-            sample_data = self.barcode_data[[barcode_col, col]].copy()
-            sample_data = sample_data[sample_data[col] > 0]  # Only non-zero counts
-            
-            # Add metadata to each barcode
-            for _, row in sample_data.iterrows():
-                try:
-                    timepoint = int(metadata['timepoint'])
-                except (ValueError, KeyError):
-                    # Skip samples with invalid timepoints
-                    continue
-                    
-                all_data.append({
-                    'barcode': row[barcode_col],
-                    'frequency': row[col],
-                    'pair': metadata['pair'],
-                    'condition': metadata['condition'],
-                    'timepoint': timepoint,
-                    'replicate': metadata['replicate']
-                })
-        
-        return pd.DataFrame(all_data)
+        # One row per (barcode, sample) with a non-zero count
+        long_data = self.barcode_data.melt(id_vars=[barcode_col], value_vars=list(metadata.index),
+                                           var_name='sample', value_name='frequency')
+        long_data = long_data[long_data['frequency'] > 0]
+        
+        df = long_data.merge(metadata, left_on='sample', right_index=True)
+        df = df.rename(columns={barcode_col: 'barcode'})
+        df = df[['barcode', 'frequency', 'pair', 'condition', 'timepoint', 'replicate']].reset_index(drop=True)
+        
+        # Repeated labels are stored as categoricals so filters and groupbys compare integer codes
+        return df.astype({c: 'category' for c in ['barcode', 'pair', 'condition', 'replicate']})
+    
+    def _sample_metadata(self, warn=False):
+        """
+        Plate map metadata for each pair sample column, indexed by column name
+        
+        Samples whose well is missing from the plate map are reported when warn is True
+        """
+        # Parse all sample column names to (plate, well) at once
+        cols = self.barcode_data.columns[1:].to_series()
+        parsed = cols.str.extract(self._COL_RE).dropna()
+        wells = pd.MultiIndex.from_arrays([parsed[0].astype(int), parsed[1]])
+        
+        # Look up each well in the plate map
+        in_map = wells.isin(self.plate_map_df.index)
+        if warn:
+            for plate, well in wells[~in_map]:
+                print(f"Warning: P{plate}_{well} not found in plate map")
+        
+        metadata = self.plate_map_df.reindex(wells[in_map])
+        metadata.index = parsed.index[in_map]
+        
+        # Skip controls if you only want pairs, and samples whose timepoint int() would reject
+        metadata = metadata[metadata['type'] == 'pair']
+        is_int = metadata['timepoint'].astype(str).str.fullmatch(r'\s*[+-]?\d+\s*')
+        return metadata[is_int].astype({'timepoint': int})
     
-    def create_pair_plot(self, pair_number):
+    def _columns_by_pair(self):
+        """Sample columns for each pair as (column, timepoint, replicate, condition) tuples"""
+        metadata = self._sample_metadata()
+        cols_by_pair = {}
+        for col, pair, tp, rep, cond in zip(metadata.index, metadata['pair'], metadata['timepoint'],
+                                            metadata['replicate'], metadata['condition']):
+            cols_by_pair.setdefault(pair, []).append((col, tp, rep, cond))
+        return cols_by_pair
+    
+    def _get_processed(self):
+        """Return process_all_data() output, computing it on first call"""
+        if self._processed is None:
+            self._processed = self.process_all_data()
+            self._by_pair = dict(tuple(self._processed.groupby('pair', observed=True)))
+        return self._processed
+    
+    def _get_pair_data(self, pair_number):
+        """Return the processed rows for one pair (empty frame if the pair has no data)"""
+        df = self._get_processed()
+        return self._by_pair.get(str(pair_number), df.iloc[0:0])
+    
+    def create_pair_plot(self, pair_number, show=False):
         """
         Create competition plot for a specific pair
         
@@ -204,15 +287,15 @@ class PlateMapStrainAnalyzer:
         -----------
         pair_number : int or str
             Pair number (e.g., 1 for Pair1)
+        show : bool
+            If True, also display the plot interactively with pyplot
         """
-        # Get all data
-        df = self.process_all_data()
-        
-        # Filter to this pair
-        pair_str = str(pair_number)
-        pair_data = df[df['pair'] == pair_str].copy()
+        # Sample columns for this pair that have any reads
+        pair_cols = pd.DataFrame(self._cols_by_pair.get(str(pair_number), []),
+                                 columns=['sample', 'timepoint', 'replicate', 'condition'])
+        pair_cols = pair_cols[(self.barcode_data[pair_cols['sample']] > 0).any().to_numpy()]
         
-        if pair_data.empty:
+        if pair_cols.empty:
             print(f"No data found for Pair {pair_number}")
             return
         
@@ -226,18 +309,33 @@ class PlateMapStrainAnalyzer:
         expected_strain_1 = strain_1.replace('_', '')
         expected_strain_2 = strain_2.replace('_', '')
         
-        # Get unique conditions
-        conditions = sorted(pair_data['condition'].unique())
+        # Non-zero counts of just the two paired strains in this pair's columns
+        barcode_col = self.barcode_data.columns[0]
+        is_strain = self.barcode_data[barcode_col].isin([expected_strain_1, expected_strain_2])
+        strain_data = self.barcode_data.loc[is_strain, [barcode_col] + list(pair_cols['sample'])]
+        pair_data = strain_data.melt(id_vars=[barcode_col], var_name='sample', value_name='frequency')
+        pair_data = pair_data[pair_data['frequency'] > 0].merge(pair_cols, on='sample')
+        pair_data = pair_data.rename(columns={barcode_col: 'barcode'})
+        
+        # Get unique conditions, and the timepoints and replicates shared by all of them
+        conditions = sorted(pair_cols['condition'].unique())
+        tps = np.sort(pair_cols['timepoint'].unique())
+        reps = np.sort(pair_cols['replicate'].unique())
+        cond_timepoints = pair_cols.groupby('condition')['timepoint'].unique()
         
-        # Setup subplots
+        # Setup subplots (only figures that will be shown are registered with pyplot,
+        # others reuse a cached figure with the same grid)
         n_cond = len(conditions)
         if n_cond <= 4:
-            fig, axes = plt.subplots(2, 2, figsize=(14, 10))
-            axes_flat = axes.flatten()
+            nrows, ncols, figsize = 2, 2, (14, 10)
+        else:
+            nrows = int(np.ceil(n_cond / 3))
+            ncols, figsize = 3, (16, 5*nrows)
+        if show:
+            fig = plt.figure(figsize=figsize)
+            axes_flat = fig.subplots(nrows, ncols).flatten()
         else:
-            rows = int(np.ceil(n_cond / 3))
-            fig, axes = plt.subplots(rows, 3, figsize=(16, 5*rows))
-            axes_flat = axes.flatten() if rows > 1 else [axes]
+            fig, axes_flat = self._get_figure(nrows, ncols, figsize)
         
         fig.suptitle(f'Pair {pair_number}: {strain_1} vs {strain_2}', 
                      fontweight='bold', fontsize=16)
@@ -248,48 +346,43 @@ class PlateMapStrainAnalyzer:
                 break
             
             ax = axes_flat[i]
-            cond_data = pair_data[pair_data['condition'] == condition].copy()
+            cond_data = pair_data[pair_data['condition'] == condition]
             
-            # Group and normalize to two-strain system
-            grouped = cond_data.groupby(['timepoint', 'replicate', 'barcode'])['frequency'].sum().reset_index()
-            
-            # Normalize each timepoint-replicate to just the two paired strains
-            for tp in grouped['timepoint'].unique():
-                for rep in grouped['replicate'].unique():
-                    mask = (grouped['timepoint'] == tp) & (grouped['replicate'] == rep)
-                    tp_rep_data = grouped[mask]
-                    
-                    # Get frequencies for the two main strains
-                    s1_freq = tp_rep_data[tp_rep_data['barcode'] == expected_strain_1]['frequency'].sum()
-                    s2_freq = tp_rep_data[tp_rep_data['barcode'] == expected_strain_2]['frequency'].sum()
-                    
-                    total = s1_freq + s2_freq
-                    
-                    if total > 0:
-                        # Normalize: A/(A+B) and B/(A+B)
-                        grouped.loc[mask & (grouped['barcode'] == expected_strain_1), 'frequency'] = s1_freq / total
-                        grouped.loc[mask & (grouped['barcode'] == expected_strain_2), 'frequency'] = s2_freq / total
-                        # Set others to 0
-                        grouped.loc[mask & (~grouped['barcode'].isin([expected_strain_1, expected_strain_2])), 'frequency'] = 0
+            # Sum counts straight into timepoint x (barcode, replicate), then normalize
+            # each timepoint-replicate to the two-strain system: A/(A+B) and B/(A+B)
+            if cond_data.empty:
+                wide = pd.DataFrame()
+            else:
+                wide = cond_data.pivot_table(index='timepoint', columns=['barcode', 'replicate'],
+                                             values='frequency', aggfunc='sum',
+                                             observed=True).sort_index()
+                
+                tp_codes = np.searchsorted(tps, wide.index.to_numpy())
+                rep_codes = np.searchsorted(reps, wide.columns.get_level_values('replicate').to_numpy())
+                gid = tp_codes[:, None] * len(reps) + rep_codes
+                freq = wide.to_numpy(dtype=np.float64, copy=True)
+                has_count = ~np.isnan(freq)
+                freq[has_count] = _normalize_by_group(gid[has_count], freq[has_count], len(tps) * len(reps))
+                wide = pd.DataFrame(freq, index=wide.index, columns=wide.columns)
             
             # Plot the two main strains
             for barcode in [expected_strain_1, expected_strain_2]:
-                strain_data = grouped[grouped['barcode'] == barcode]
-                if strain_data.empty:
+                if barcode not in wide.columns.get_level_values(0):
                     continue
                 
+                strain_wide = wide[barcode]
                 color = self._get_strain_color(barcode)
                 
                 # Plot each replicate
-                for rep in sorted(strain_data['replicate'].unique()):
-                    rep_data = strain_data[strain_data['replicate'] == rep].sort_values('timepoint')
+                for rep, series in strain_wide.items():
+                    series = series.dropna()
                     
-                    if not rep_data.empty:
+                    if not series.empty:
                         linestyle = '-' if rep == '1' else '--'
                         alpha = 0.9 if rep == '1' else 0.7
-                        label = f'{barcode}' + (f' (R{rep})' if len(strain_data['replicate'].unique()) > 1 else '')
+                        label = f'{barcode}' + (f' (R{rep})' if len(strain_wide.columns) > 1 else '')
                         
-                        ax.plot(rep_data['timepoint'], rep_data['frequency'],
+                        ax.plot(series.index, series.values,
                                marker='o', linewidth=3, markersize=8, color=color,
                                linestyle=linestyle, alpha=alpha, label=label,
                                markeredgecolor='white', markeredgewidth=0.5)
@@ -300,7 +393,7 @@ class PlateMapStrainAnalyzer:
             ax.set_title(condition, fontweight='bold', pad=15)
             
             # Set x-axis based on actual timepoints
-            timepoints = sorted(grouped['timepoint'].unique())
+            timepoints = np.sort(cond_timepoints[condition])
             ax.set_xticks(timepoints)
             ax.set_xlim(min(timepoints) - 0.5, max(timepoints) + 0.5)
             
@@ -315,30 +408,49 @@ class PlateMapStrainAnalyzer:
         for idx in range(len(conditions), len(axes_flat)):
             axes_flat[idx].set_visible(False)
         
-        plt.tight_layout()
-        plt.savefig(f'Pair{pair_number}_competition.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        fig.tight_layout()
+        fig.savefig(f'Pair{pair_number}_competition.png', dpi=300, bbox_inches='tight')
+        if show:
+            plt.show()
         print(f"Plot saved as Pair{pair_number}_competition.png")
     
-    def analyze_all_pairs(self):
-        """Generate plots for all pairs"""
-        for pair_key in self.strain_pairs.keys():
-            pair_num = pair_key.replace('Pair', '')
-            print(f"\nProcessing {pair_key}...")
-            self.create_pair_plot(pair_num)
+    def analyze_all_pairs(self, jobs=1, show=False):
+        """
+        Generate plots for all pairs (shown interactively only if show=True)
+        
+        With jobs other than 1, pairs are rendered in that many worker processes
+        (0 = one per CPU) and their output is printed in pair order; plots from
+        worker processes cannot be shown, so show=True requires jobs=1
+        """
+        if show and jobs != 1:
+            raise ValueError("show=True requires jobs=1")
+        
+        if jobs == 1:
+            for pair_key in self.strain_pairs.keys():
+                pair_num = pair_key.replace('Pair', '')
+                print(f"\nProcessing {pair_key}...")
+                self.create_pair_plot(pair_num, show=show)
+            return
+        
+        pair_keys = list(self.strain_pairs.keys())
+        pair_nums = [pair_key.replace('Pair', '') for pair_key in pair_keys]
+        max_workers = jobs if jobs > 0 else os.cpu_count()
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            for pair_key, output in zip(pair_keys, executor.map(_render_pair, pair_nums)):
+                print(f"\nProcessing {pair_key}...")
+                sys.stdout.write(output)
     
     def export_processed_data(self, output_file='processed_competition_data.csv'):
         """Export all processed data to CSV"""
-        df = self.process_all_data()
+        df = self._get_processed()
         df.to_csv(output_file, index=False)
         print(f"Data exported to {output_file}")
         return df
     
     def get_pair_summary(self, pair_number):
         """Get summary statistics for a pair"""
-        df = self.process_all_data()
-        pair_str = str(pair_number)
-        pair_data = df[df['pair'] == pair_str]
+        pair_data = self._get_pair_data(pair_number)
         
         if pair_data.empty:
             print(f"No data for Pair {pair_number}")
@@ -356,6 +468,8 @@ class PlateMapStrainAnalyzer:
 
 def main():
     """Example usage"""
+    # Batch mode: render straight to PNG without a GUI backend
+    matplotlib.use('Agg')
     
     # File paths - UPDATE THESE
     barcode_file = "Coexistence_Assays/Data Analysis/barcodecounts_clean.csv"